@@ -1,51 +1,344 @@
 from datetime import datetime
+from collections import OrderedDict
+from threading import RLock, Thread, Event
 from lstore.page import Page
 from lstore.config import *
-import pickle
+from lstore import compression
+import struct
+import mmap
+import shutil
+import zlib
+import sys
 import os
 
+# Each (table, page type, column, page range) is stored in one segment file.
+# Page n of that segment lives at offset n * PAGE_SLOT_SIZE and is laid out as
+# a PAGE_HEADER_SIZE byte header followed by up to PAGE_CAPACITY data bytes:
+#
+#   offset  size  field
+#   0       4     magic, b'LSPG'
+#   4       2     format version (PAGE_FORMAT_VERSION)
+#   6       2     flags, bit 0 set when the data slots are big-endian
+#   8       4     CRC-32 of num_records, TPS and the stored data bytes
+#   12      8     num_records
+#   20      8     TPS
+#   28      2     encoding, compression.RAW/FOR/DELTA (zero in version 1)
+#   30      2     length of the encoded data (zero for RAW)
+#
+# Header fields are little-endian; data slots are unsigned 64-bit integers in
+# the byte order of the host that wrote them. RAW pages store all
+# PAGE_CAPACITY data bytes, encoded pages only their payload, which is
+# decoded when the page is loaded. Slots keep a fixed size so a page's offset
+# follows from its number. Slots that may be encoded are read header first and
+# then only the bytes they store, and the unused tail of an encoded slot in the
+# preallocated (sparse) segment is never written; other slots are read whole
+# with one scatter read. A slot that was never written reads back
+# as zeros (no magic), which is an empty page.
+# In 'mmap' mode segments are mapped into memory and a page read from disk
+# uses a memoryview over its slot as Page.data, so nothing is copied until
+# the page is first changed (Page.own_data).
+PAGE_HEADER = struct.Struct('<4sHHIQQHH')
+PAGE_COUNTS = struct.Struct('<QQ')
+PAGE_MAGIC = b'LSPG'
+EMPTY_MAGIC = bytes(4)
+PAGE_FLAGS = 1 if sys.byteorder == 'big' else 0
+
+
+def page_checksum(num_records, TPS, data):
+    return zlib.crc32(data, zlib.crc32(PAGE_COUNTS.pack(num_records, TPS)))
+
+
+def pack_page_header(page, encoding = compression.RAW, payload = None):
+    data = page.data if payload is None else payload
+    checksum = page_checksum(page.num_records, page.TPS, data)
+    length = 0 if payload is None else len(payload)
+    return PAGE_HEADER.pack(PAGE_MAGIC, PAGE_FORMAT_VERSION, PAGE_FLAGS, checksum,
+                            page.num_records, page.TPS, encoding, length)
+
+
+def unpack_page_header(header, data, id):
+    """
+    Validates a page header against the slot data and returns
+    (num_records, TPS, encoding, payload), or None for a slot that was never
+    written. Raises IOError on corruption.
+    """
+    magic, version, flags, checksum, num_records, TPS, encoding, length = PAGE_HEADER.unpack_from(header)
+    if magic == EMPTY_MAGIC:
+        return None
+    if magic != PAGE_MAGIC:
+        raise IOError(f"page {id} is not an lstore page")
+    if not 1 <= version <= PAGE_FORMAT_VERSION:
+        raise IOError(f"page {id} has unsupported format version {version}")
+    if flags != PAGE_FLAGS:
+        raise IOError(f"page {id} was written with a different byte order")
+    payload = data if encoding == compression.RAW else data[:length]
+    if checksum != page_checksum(num_records, TPS, payload):
+        raise IOError(f"page {id} failed its checksum, it is torn or corrupt")
+    return num_records, TPS, encoding, payload
+
+
+def load_page(page, counts):
+    """Fills a page from validated header fields, decoding its data if it was encoded."""
+    page.num_records, page.TPS, encoding, payload = counts
+    if encoding != compression.RAW:
+        values = compression.decode(encoding, bytes(payload), page.num_records)
+        page.data = bytearray(PAGE_CAPACITY)
+        page.values[:page.num_records] = values
+    return page
+
 class BufferPool:
     storage_path = ""
-    cache = {}
-    max_cache_size = 0
-    
-    
-    def __init__(page_cache, size = 2000):
-        page_cache.max_cache_size = size
-        
-    @classmethod 
+    cache = OrderedDict()
+    max_cache_size = BUFFERPOOL_MAX_LENGTH
+    eviction_policy = BUFFERPOOL_EVICTION_POLICY
+    referenced = set()
+    lock = RLock()
+    writer = None
+    writer_stop = Event()
+    segments = OrderedDict()
+    max_open_segments = MAX_OPEN_SEGMENTS
+    maps = {}
+    io_mode = 'pread'
+    compress = False
+
+
+    def __init__(page_cache, size = None, policy = None):
+        if size is not None:
+            BufferPool.set_cache_size(size)
+        if policy is not None:
+            BufferPool.set_eviction_policy(policy)
+
+    @classmethod
     def set_storage_path(page_cache, path):
         """Sets the storage directory for persisting pages."""
         page_cache.storage_path = path
-    
+
+    @classmethod
+    def set_cache_size(page_cache, size):
+        """Sets the maximum number of pages held in memory."""
+        page_cache.max_cache_size = size
+
+    @classmethod
+    def set_eviction_policy(page_cache, policy):
+        """Selects the replacement policy used when the cache is full ('lru' or 'clock')."""
+        if policy not in ('lru', 'clock'):
+            raise ValueError(f"unknown eviction policy {policy}")
+        page_cache.eviction_policy = policy
+        page_cache.referenced.clear()
+
+    @classmethod
+    def set_max_open_segments(page_cache, count):
+        """
+        Sets how many segment files are kept open at once. In 'mmap' mode every
+        open segment also has a memory map, which holds a descriptor of its own.
+        """
+        page_cache.max_open_segments = count
+
+    @classmethod
+    def set_io_mode(page_cache, mode):
+        """Selects how pages are read from segment files ('pread' or 'mmap')."""
+        if mode not in ('pread', 'mmap'):
+            raise ValueError(f"unknown io mode {mode}")
+        page_cache.io_mode = mode
+
+    @classmethod
+    def set_compression(page_cache, enabled):
+        """Enables encoding full base pages with FOR/DELTA when they are written."""
+        page_cache.compress = enabled
+
+    @classmethod
+    def may_encode(page_cache, id):
+        """
+        Base and merged pages are read-mostly, except for the indirection and schema
+        encoding columns which are updated in place and always stay raw.
+        """
+        return (page_cache.compress and id[1] in ("base", "merged")
+                and id[2] not in (INDIRECTION_COLUMN, SCHEMA_ENCODING_COLUMN))
+
+    @classmethod
+    def should_compress(page_cache, id, page):
+        """Full pages of the columns that may be encoded are encoded when written."""
+        return page_cache.may_encode(id) and page.num_records == TUPLES_PER_PAGE
+
+    @classmethod
+    def is_persistent(page_cache):
+        """Checks if the pool has a directory to read pages from and evict pages to."""
+        return page_cache.storage_path != ""
+
     @classmethod
     def is_cached(page_cache, id):
         """Checks if a page exists in the cache."""
-        return id in page_cache.cache.keys()
+        return id in page_cache.cache
 
     @classmethod
     def store_page(page_cache, id, page):
-        """Stores a page in memory and marks it as modified."""
-        page_cache.cache[id] = page
-        page_cache.cache[id].setAsdirty()
+        """Stores a page in memory without marking it as modified."""
+        with page_cache.lock:
+            page_cache.evict()
+            page_cache.cache[id] = page
 
     @classmethod
     def update_cache(page_cache, id, page):
         """Updates an existing page in memory and marks it as modified."""
-        page_cache.cache[id] = page
-        page_cache.cache[id].setAsdirty()
+        with page_cache.lock:
+            if id not in page_cache.cache:
+                page_cache.evict()
+            page_cache.cache[id] = page
+            page_cache.cache[id].setAsdirty()
+            page_cache.touch(id)
 
     @classmethod
     def is_cache_full(page_cache):
         """Checks if the cache has reached its maximum capacity."""
-        return len(page_cache.cache) >= 2000
+        return len(page_cache.cache) >= page_cache.max_cache_size
+
+    @classmethod
+    def construct_segment_path(page_cache, buffer_id):
+        """Generates the path of the segment file holding the page."""
+        dirname = os.path.join(page_cache.storage_path, buffer_id[0], str(buffer_id[3]))
+        return os.path.join(dirname, f"{buffer_id[1]}_{buffer_id[2]}.seg")
+
+    @classmethod
+    def page_offset(page_cache, buffer_id):
+        """Returns the offset of the page inside its segment file."""
+        return buffer_id[4] * PAGE_SLOT_SIZE
+
+    @classmethod
+    def open_segment(page_cache, buffer_id, create = False):
+        """
+        Returns a file descriptor for the segment holding the page, or None if the
+        segment does not exist and create is False. Up to max_open_segments
+        descriptors are kept open, the least recently used one is closed first.
+        Callers hold the pool lock while they use the descriptor.
+        """
+        path = page_cache.construct_segment_path(buffer_id)
+        with page_cache.lock:
+            if path in page_cache.segments:
+                page_cache.segments.move_to_end(path)
+                return page_cache.segments[path]
+            if not create:
+                try:
+                    fd = os.open(path, os.O_RDWR)
+                except FileNotFoundError:
+                    return None
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                # preallocate a whole page range worth of slots up front
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, MAX_PAGES_PER_RANGE * PAGE_SLOT_SIZE)
+            while len(page_cache.segments) >= page_cache.max_open_segments:
+                page_cache.close_segment(next(iter(page_cache.segments)))
+            page_cache.segments[path] = fd
+            return fd
+
+    @classmethod
+    def close_segment(page_cache, path):
+        """Closes an open segment file and unmaps it."""
+        with page_cache.lock:
+            segment_map = page_cache.maps.pop(path, None)
+            if segment_map is not None:
+                # a map keeps a descriptor of its own, cached pages viewing it
+                # get a copy of their data so it can be unmapped now
+                for page in page_cache.cache.values():
+                    if isinstance(page.data, memoryview) and page.data.obj is segment_map:
+                        page.own_data()
+                try:
+                    segment_map.close()
+                except BufferError:
+                    # pages still hold views over the map, it is released with them
+                    pass
+            os.close(page_cache.segments.pop(path))
+
+    @classmethod
+    def map_segment(page_cache, buffer_id, create = False):
+        """
+        Returns a shared memory map of the segment holding the page, or None if
+        the page lies outside the segment and create is False. When create is
+        True the segment is grown by whole page ranges and remapped as needed.
+        """
+        fd = page_cache.open_segment(buffer_id, create)
+        if fd is None:
+            return None
+        path = page_cache.construct_segment_path(buffer_id)
+        end = page_cache.page_offset(buffer_id) + PAGE_SLOT_SIZE
+        with page_cache.lock:
+            segment_map = page_cache.maps.get(path)
+            if segment_map is not None and len(segment_map) >= end:
+                return segment_map
+            size = os.fstat(fd).st_size
+            if size < end:
+                if not create:
+                    return None
+                range_size = MAX_PAGES_PER_RANGE * PAGE_SLOT_SIZE
+                size = -(-end // range_size) * range_size
+                os.ftruncate(fd, size)
+            # a replaced map stays alive for as long as pages still view it
+            segment_map = mmap.mmap(fd, size)
+            page_cache.maps[path] = segment_map
+            return segment_map
+
+    @classmethod
+    def close_segments(page_cache):
+        """Closes every open segment file and memory map."""
+        with page_cache.lock:
+            for segment_map in page_cache.maps.values():
+                segment_map.flush()
+            for path in list(page_cache.segments):
+                page_cache.close_segment(path)
+
+    @classmethod
+    def drop_range(page_cache, table, pindx):
+        """
+        Discards every cached page of a page range without writing it back and
+        deletes the range's segment files.
+        """
+        with page_cache.lock:
+            for id in [id for id in page_cache.cache if id[0] == table and id[3] == pindx]:
+                del page_cache.cache[id]
+                page_cache.referenced.discard(id)
+            if not page_cache.is_persistent():
+                return
+            dirname = os.path.join(page_cache.storage_path, table, str(pindx))
+            for path in [path for path in page_cache.segments if os.path.dirname(path) == dirname]:
+                page_cache.close_segment(path)
+            shutil.rmtree(dirname, ignore_errors=True)
 
     @classmethod
-    def construct_page_path(page_cache, buffer_id):
-        """Generates a file path for storing the page."""
-        dirname = os.path.join(page_cache.storage_path, str(buffer_id[2]), str(buffer_id[3]), buffer_id[1])
-        dirr = os.path.join(dirname, str(buffer_id[4]) + '.pkl')
-        return dirr
+    def touch(page_cache, id):
+        """Records an access to a cached page for the eviction policy."""
+        if page_cache.eviction_policy == 'lru':
+            page_cache.cache.move_to_end(id)
+        else:
+            page_cache.referenced.add(id)
+
+    @classmethod
+    def evict(page_cache):
+        """
+        Makes room for one more page when the cache is full.
+        Pinned pages are never evicted and only dirty victims are written back.
+        If every cached page is pinned the cache is allowed to grow past its limit.
+        """
+        if not page_cache.is_persistent():
+            return
+        with page_cache.lock:
+            # LRU keeps the cache ordered by recency; CLOCK gives referenced
+            # pages a second chance by clearing their bit and moving them back
+            # behind the hand, which is the same sweep over an ordered ring.
+            chances = 2 * len(page_cache.cache)
+            while page_cache.is_cache_full() and chances > 0:
+                chances -= 1
+                id, page = next(iter(page_cache.cache.items()))
+                if page.pinned > 0:
+                    page_cache.cache.move_to_end(id)
+                    continue
+                if id in page_cache.referenced:
+                    page_cache.referenced.discard(id)
+                    page_cache.cache.move_to_end(id)
+                    continue
+                del page_cache.cache[id]
+                if page.is_dirty:
+                    page_cache.write(page, id)
 
     @classmethod
     def get(page_cache, id):
@@ -53,53 +346,178 @@ class BufferPool:
         Retrieves a page from cache or loads it from disk.
         If the page does not exist, a new one is created.
         """
-        if id in page_cache.cache:
-            return page_cache.cache[id]
+        with page_cache.lock:
+            if id in page_cache.cache:
+                page_cache.touch(id)
+                return page_cache.cache[id]
+
+            page = page_cache.read(id) if page_cache.is_persistent() else None
 
-        dirPath = page_cache.construct_page_path(id)
+            if page is None:
+                # Page does not exist on disk, create a new one
+                page = Page()
+                page_cache.store_page(id, page)
+                return page
+            else:
+                # Load page from disk if not in cache
+                page_cache.evict()
+                page_cache.cache[id] = page
+                return page
 
-        if not os.path.isfile(dirPath):
-            # Page does not exist on disk, create a new one
-            page = Page()
-            page_cache.store_page(id, page)
+    @classmethod
+    def pin(page_cache, id):
+        """Retrieves a page and pins it so it cannot be evicted until unpinned."""
+        with page_cache.lock:
+            page = page_cache.get(id)
+            page.pinned += 1
             return page
+
+    @classmethod
+    def unpin(page_cache, page):
+        """Releases one pin taken on a page by pin."""
+        with page_cache.lock:
+            if page.pinned > 0:
+                page.pinned -= 1
+
+    @classmethod
+    def read(page_cache, id):
+        """Reads a page from its segment file, or returns None if it was never written."""
+        if page_cache.io_mode == 'mmap':
+            return page_cache.read_mapped(id)
+        fd = page_cache.open_segment(id)
+        if fd is None:
+            return None
+        offset = page_cache.page_offset(id)
+        header = bytearray(PAGE_HEADER_SIZE)
+        page = Page()
+        # one scatter read puts the data bytes straight into the page buffer,
+        # except for slots that may hold a short encoded payload: their header
+        # is read first and then only the bytes the slot stores
+        whole_slot = not page_cache.may_encode(id)
+        read = os.preadv(fd, [header, page.data] if whole_slot else [header], offset)
+        if read < PAGE_HEADER_SIZE:
+            return None
+        if header[:len(EMPTY_MAGIC)] == EMPTY_MAGIC:
+            return page
+        encoding, length = PAGE_HEADER.unpack_from(header)[-2:]
+        stored = PAGE_CAPACITY if encoding == compression.RAW else length
+        if whole_slot:
+            read -= PAGE_HEADER_SIZE
+            data = page.data if encoding == compression.RAW else page.data[:length]
+        elif encoding == compression.RAW:
+            read = os.preadv(fd, [page.data], offset + PAGE_HEADER_SIZE)
+            data = page.data
         else:
-            # Load page from disk if not in cache
-            if not page_cache.is_cached(id):
-                page_cache.cache[id] = page_cache.read(dirPath)
-            return page_cache.cache[id]
-    
-    @classmethod
-    def read(page_cache, file_path):
-        """Reads a page from disk storage."""
-        f = open(file_path, 'r+b')
+            data = os.pread(fd, length, offset + PAGE_HEADER_SIZE)
+            read = len(data)
+        if read < stored:
+            raise IOError(f"page {id} is cut short, it is torn or corrupt")
+        counts = unpack_page_header(header, data, id)
+        if counts is None:
+            return page
+        return load_page(page, counts)
+
+    @classmethod
+    def read_mapped(page_cache, id):
+        """Returns a page whose data is a view over its slot in the mapped segment."""
+        segment_map = page_cache.map_segment(id)
+        if segment_map is None:
+            return None
+        offset = page_cache.page_offset(id)
+        start = offset + PAGE_HEADER_SIZE
+        data = memoryview(segment_map)[start:start + PAGE_CAPACITY]
+        counts = unpack_page_header(segment_map[offset:start], data, id)
         page = Page()
-        metadata = pickle.load(f)
-        
-        page.num_records = metadata[0]
-        page.is_dirty = metadata[1]
-        page.pinned = metadata[2]
-        page.TPS = metadata[3]
-        page.data = pickle.load(f)
-        f.close()
-        return page
+        page.data = data
+        if counts is None:
+            return page
+        return load_page(page, counts)
 
     @classmethod
     def write(page_cache, page, id):
-        """Writes a page to disk to ensure persistence."""
-        directory = os.path.join(page_cache.storage_path, str(id[2]), str(id[3]), id[1])
-        file_path = os.path.join(directory, f"{id[4]}.pkl")
+        """Writes a page to its slot in the segment file and marks it as clean."""
+        offset = page_cache.page_offset(id)
+        encoding, payload = compression.RAW, None
+        if page_cache.should_compress(id, page):
+            encoding, payload = compression.encode(page.get_values())
+        header = pack_page_header(page, encoding, payload)
+        data = page.data if payload is None else payload
+        if page_cache.io_mode == 'mmap':
+            segment_map = page_cache.map_segment(id, create=True)
+            start = offset + PAGE_HEADER_SIZE
+            if payload is not None:
+                # the payload overwrites the slot, so the page keeps its own copy
+                page.own_data()
+            if not isinstance(data, memoryview) or data.obj is not segment_map:
+                segment_map[start:start + len(data)] = data
+            segment_map[offset:start] = header
+        else:
+            fd = page_cache.open_segment(id, create=True)
+            os.pwritev(fd, [header, data], offset)
+        page.is_dirty = False
 
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    @classmethod
+    def dirty_pages(page_cache, table = None):
+        """Returns the ids of the cached pages that changed since they were last written."""
+        with page_cache.lock:
+            return [id for id, page in page_cache.cache.items()
+                    if page.is_dirty and (table is None or id[0] == table)]
 
-        with open(file_path, "wb") as file:
-            metadata = [page.num_records, page.is_dirty, page.pinned, page.TPS]
-            pickle.dump(metadata, file)
-            pickle.dump(page.data, file)
+    @classmethod
+    def flush(page_cache, table = None, limit = None):
+        """
+        Writes dirty pages back to disk, for one table if a name is given.
+        At most limit pages are written when a limit is given.
+        Returns the number of pages written.
+        """
+        if not page_cache.is_persistent():
+            return 0
+        written = 0
+        for id in page_cache.dirty_pages(table):
+            if limit is not None and written >= limit:
+                break
+            # write page by page under the lock so a concurrent eviction can
+            # never race an older copy of the same page onto disk
+            with page_cache.lock:
+                page = page_cache.cache.get(id)
+                if page is None or not page.is_dirty:
+                    continue
+                page_cache.write(page, id)
+            written += 1
+        return written
+
+    @classmethod
+    def start_page_writer(page_cache, interval = PAGE_WRITER_INTERVAL, batch = PAGE_WRITER_BATCH):
+        """
+        Starts a daemon thread flushing up to batch dirty pages every interval seconds.
+        A batch of 0 leaves the writer disabled.
+        """
+        if batch <= 0 or page_cache.writer is not None:
+            return
+        page_cache.writer_stop.clear()
+        page_cache.writer = Thread(target=page_cache._run_page_writer, args=(interval, batch), daemon=True)
+        page_cache.writer.start()
+
+    @classmethod
+    def stop_page_writer(page_cache):
+        """Stops the background page writer and waits for it to exit."""
+        if page_cache.writer is None:
+            return
+        page_cache.writer_stop.set()
+        page_cache.writer.join()
+        page_cache.writer = None
+
+    @classmethod
+    def _run_page_writer(page_cache, interval, batch):
+        while not page_cache.writer_stop.wait(interval):
+            page_cache.flush(limit=batch)
 
     @classmethod
     def shutdown(page_cache):
-        """Flushes all cached pages to disk before closing the program."""
-        for id, page in page_cache.cache.items():
-            page_cache.write(page, id)
+        """Flushes all dirty pages to disk before closing the program."""
+        page_cache.stop_page_writer()
+        page_cache.flush()
+        with page_cache.lock:
+            page_cache.cache.clear()
+            page_cache.referenced.clear()
+        page_cache.close_segments()
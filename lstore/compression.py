@@ -0,0 +1,67 @@
+from array import array
+from itertools import accumulate
+import struct
+
+"""
+Lightweight encodings for the written slots of a full base page.
+Values are packed byte-aligned (1, 2, 4 or 8 bytes each) so packing and
+unpacking go through array rather than per-value bit twiddling.
+
+FOR (frame of reference): min value, width, then value - min for every slot.
+DELTA: first value, width, then the difference to the previous slot. Only
+used when the values never decrease (RIDs, timestamps).
+"""
+
+RAW = 0
+FOR = 1
+DELTA = 2
+
+PACKED_HEADER = struct.Struct('<QB')
+WIDTH_TYPECODES = {array(typecode).itemsize: typecode for typecode in 'QLIHB'}
+
+
+def _pack(base, offsets):
+    top = max(offsets, default=0)
+    width = 0
+    if top:
+        width = next(w for w in sorted(WIDTH_TYPECODES) if top < 1 << (8 * w))
+    payload = PACKED_HEADER.pack(base, width)
+    if width:
+        payload += array(WIDTH_TYPECODES[width], offsets).tobytes()
+    return payload
+
+
+def encode(values):
+    """
+    Returns (encoding, payload) for a list of slot values, picking the smallest
+    of FOR and DELTA, or (RAW, None) if neither is smaller than the raw slots.
+    """
+    if not values:
+        return RAW, None
+    base = min(values)
+    best = (FOR, _pack(base, [value - base for value in values]))
+    deltas = [current - previous for previous, current in zip(values, values[1:])]
+    if min(deltas, default=0) >= 0:
+        delta_payload = _pack(values[0], deltas)
+        if len(delta_payload) < len(best[1]):
+            best = (DELTA, delta_payload)
+    if len(best[1]) >= len(values) * 8:
+        return RAW, None
+    return best
+
+
+def decode(encoding, payload, count):
+    """Returns an array('Q') holding the count slot values packed in payload."""
+    base, width = PACKED_HEADER.unpack_from(payload)
+    packed_count = count if encoding == FOR else count - 1
+    if width:
+        packed = array(WIDTH_TYPECODES[width])
+        start = PACKED_HEADER.size
+        packed.frombytes(payload[start:start + packed_count * width])
+    else:
+        packed = [0] * packed_count
+    if encoding == FOR:
+        return array('Q', [base + offset for offset in packed])
+    if encoding == DELTA:
+        return array('Q', accumulate(packed, initial=base))
+    raise ValueError(f"unknown page encoding {encoding}")
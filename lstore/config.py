@@ -13,3 +13,15 @@ TUPLES_PER_PAGERANGE = MAX_PAGES_PER_RANGE * TUPLES_PER_PAGE
 DEFAULT_PAGE_COUNT = 5  
 MAX_64BIT_INT = 2**64 - 1  
 BUFFERPOOL_MAX_LENGTH = 1000
+PAGE_HEADER_SIZE = 32
+PAGE_FORMAT_VERSION = 2
+PAGE_SLOT_SIZE = PAGE_HEADER_SIZE + PAGE_CAPACITY
+BUFFERPOOL_EVICTION_POLICY = 'lru'
+PAGE_WRITER_INTERVAL = 1.0
+PAGE_WRITER_BATCH = 64
+MAX_OPEN_SEGMENTS = 256
+MERGE_THRESHOLD = TUPLES_PER_PAGE
+COMPACTION_THRESHOLD = 0.5
+DEFAULT_INDEX_KIND = 'btree'
+ADAPTIVE_INDEX_THRESHOLD = 8
+ADAPTIVE_INDEX_IDLE = 1000
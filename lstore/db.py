@@ -1,5 +1,10 @@
 from lstore.table import Table
 from lstore.bufferpool import BufferPool
+from lstore.query import Query
+from lstore.loader import read_csv, read_binary, batches
+from lstore.config import TUPLES_PER_PAGERANGE
+from time import time
+from array import array
 import os
 import pickle
 
@@ -10,9 +15,14 @@ class Database():
         self.directory_path = ""
 
     # Not required for milestone1
-    def open(self, path):
+    # mmap=True maps segment files into memory instead of reading pages with pread
+    # compress=True stores full base pages FOR/DELTA encoded on disk
+    def open(self, path, mmap=False, compress=False):
         self.directory_path = path
         BufferPool().set_storage_path(self.directory_path)
+        BufferPool.set_io_mode('mmap' if mmap else 'pread')
+        BufferPool.set_compression(compress)
+        BufferPool.start_page_writer()
         
         if not os.path.exists(path):
             os.makedirs(path)
@@ -27,16 +37,29 @@ class Database():
                 table.page_directory = metadata[3]
                 table.records = metadata[4]
                 table.updates = metadata[5]
-                table.RID_map = metadata[6]
+                keys, rids = metadata[6]
+                table.RID_map.update(list(zip(keys, rids)))
+                table.merged = metadata[7]
+                table.tail_counts = metadata[8]
+                table.deleted_counts = metadata[9]
+                table.freed_ranges = metadata[10]
                 table.path = self.directory_path
+                table.index.load(self.index_path(table.name))
 
 
     def close(self):
         metadata = {}
         for table in self.tables.values():
+            table.stop_merge()
+            table.index.save(self.index_path(table.name))
             metadata[table.name] = [table.name, table.num_columns, table.key, table.page_directory, table.records]
             metadata[table.name].append(table.updates)
-            metadata[table.name].append(table.RID_map)
+            # as flat arrays: pickling a large BTree recurses through its bucket chain
+            metadata[table.name].append((array('Q', table.RID_map.keys()), array('Q', table.RID_map.values())))
+            metadata[table.name].append(table.merged)
+            metadata[table.name].append(table.tail_counts)
+            metadata[table.name].append(table.deleted_counts)
+            metadata[table.name].append(table.freed_ranges)
         metadata_file = os.path.join(self.directory_path, "db_catalog.pkl")
         file = open(metadata_file, 'w+b')
         pickle.dump(metadata, file)
@@ -46,6 +69,45 @@ class Database():
         #     pickle.dump(metadata, file)
         BufferPool.shutdown()
 
+    def index_path(self, table_name):
+        return os.path.join(self.directory_path, table_name, "indexes.pkl")
+
+    """
+    # Bulk loads rows from a file into an existing table
+    :param table_name: string   #Table to load into
+    :param path: string         #CSV file, or raw native-endian unsigned 64-bit integers for "binary"
+    :param format: string       #"csv" or "binary"
+    # Rows are streamed in batches of batch_size, so memory stays bounded by one batch.
+    # Indexes are built at the end from the loaded base pages, sorted per column.
+    # A bad row raises ValueError; the batches before it stay loaded and indexed.
+    # Returns a dict with the number of rows, seconds taken and rows_per_sec
+    """
+    def load(self, table_name, path, format="csv", batch_size=TUPLES_PER_PAGERANGE, skip_header=False):
+        table = self.get_table(table_name)
+        if table is None:
+            return False
+        if format == "csv":
+            rows = read_csv(path, table.num_columns, skip_header)
+        elif format == "binary":
+            rows = read_binary(path, table.num_columns)
+        else:
+            raise ValueError(f"unknown load format {format}")
+
+        query = Query(table)
+        start = time()
+        first_rid = table.records
+        loaded = 0
+        try:
+            for batch in batches(rows, batch_size):
+                if not query.insert_many(batch, index=False):
+                    raise ValueError(f"{path}: duplicate key or out of range value in rows {loaded + 1}..{loaded + len(batch)}")
+                loaded += len(batch)
+        finally:
+            # batches inserted before an error stay in the table, so they are indexed too
+            table.index.build(first_rid)
+        seconds = time() - start
+        return {"rows": loaded, "seconds": seconds, "rows_per_sec": loaded / seconds if seconds else float(loaded)}
+
     """
     # Creates a new table
     :param name: string         #Table name
@@ -0,0 +1,77 @@
+from array import array
+
+"""
+A compact page directory. RIDs are handed out densely from the table's record
+counter, so the location of every record lives in one 64-bit slot of a typed
+array indexed by RID instead of a dict of Python lists. Each slot packs the
+page type, page range, page and offset; an all-zero slot means no record.
+"""
+
+PAGE_TYPES = ("base", "tail")
+OFFSET_BITS = 12
+PAGE_BITS = 24
+RANGE_BITS = 24
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+PAGE_MASK = (1 << PAGE_BITS) - 1
+RANGE_MASK = (1 << RANGE_BITS) - 1
+
+
+class PageDirectory:
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.slots = array('Q')
+        self.count = 0
+
+    def __getitem__(self, rid):
+        """Returns (table name, page type, page range, page, offset) for a RID."""
+        slot = self.slots[rid] if 0 <= rid < len(self.slots) else 0
+        if not slot:
+            raise KeyError(rid)
+        offset = slot & OFFSET_MASK
+        slot >>= OFFSET_BITS
+        bindx = slot & PAGE_MASK
+        slot >>= PAGE_BITS
+        pindx = slot & RANGE_MASK
+        return (self.table_name, PAGE_TYPES[(slot >> RANGE_BITS) - 1], pindx, bindx, offset)
+
+    def __setitem__(self, rid, location):
+        _, page_type, pindx, bindx, offset = location
+        if offset > OFFSET_MASK or bindx > PAGE_MASK or pindx > RANGE_MASK:
+            raise ValueError(f"location {location} does not fit in a directory slot")
+        slot = (PAGE_TYPES.index(page_type) + 1) << RANGE_BITS | pindx
+        slot = ((slot << PAGE_BITS | bindx) << OFFSET_BITS) | offset
+        if rid >= len(self.slots):
+            self.slots.extend([0] * (rid + 1 - len(self.slots)))
+        if not self.slots[rid]:
+            self.count += 1
+        self.slots[rid] = slot
+
+    def set_run(self, rid, page_type, pindx, bindx, offset, count):
+        """Records count consecutive RIDs stored in consecutive slots of one page."""
+        self[rid] = (self.table_name, page_type, pindx, bindx, offset)
+        if count == 1:
+            return
+        if offset + count - 1 > OFFSET_MASK:
+            raise ValueError(f"run of {count} records does not fit in a page")
+        first = self.slots[rid]
+        end = rid + count
+        if end > len(self.slots):
+            self.slots.extend([0] * (end - len(self.slots)))
+        self.count += sum(1 for slot in self.slots[rid + 1:end] if not slot)
+        self.slots[rid + 1:end] = array('Q', range(first + 1, first + count))
+
+    def __delitem__(self, rid):
+        if rid not in self:
+            raise KeyError(rid)
+        self.slots[rid] = 0
+        self.count -= 1
+
+    def __contains__(self, rid):
+        return 0 <= rid < len(self.slots) and self.slots[rid] != 0
+
+    def __iter__(self):
+        return (rid for rid, slot in enumerate(self.slots) if slot)
+
+    def __len__(self):
+        return self.count
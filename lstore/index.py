@@ -1,66 +1,423 @@
 from lstore.page import Page
 from BTrees.OOBTree import OOBTree
+from BTrees.QQBTree import QQBTree
+from itertools import groupby
+from operator import itemgetter
+from threading import RLock, Thread
+from array import array
+from lstore.config import DEFAULT_INDEX_KIND, ADAPTIVE_INDEX_THRESHOLD, ADAPTIVE_INDEX_IDLE, MAX_64BIT_INT
+from lstore import postings as posting_lists
+import pickle
+import os
+
+MIN_KEY = 0
+MAX_KEY = MAX_64BIT_INT
 
 """
 A data strucutre holding indices for various columns of a table. Key column should be indexd by default, other columns can be indexed through this object. Indices are usually B-Trees, but other data structures can be used as well.
 """
 
+
+class BTreeIndex(OOBTree):
+    """Ordered index mapping each value to its posting list, for equality and range lookups."""
+    kind = "btree"
+
+    def range(self, begin, end):
+        """Returns the posting lists of the values between begin and end, in order."""
+        return self.values(min=begin, max=end)
+
+    def sorted_items(self):
+        return self.items()
+
+
+class HashIndex(dict):
+    """
+    Hash index mapping each value to its posting list. Point lookups cost one
+    hash probe; range lookups have to test every value.
+    """
+    kind = "hash"
+
+    def range(self, begin, end):
+        """Returns the posting lists of the values between begin and end, in order."""
+        return [self[value] for value in sorted(value for value in self if begin <= value <= end)]
+
+    def sorted_items(self):
+        return sorted(self.items())
+
+
+class PrimaryKeyIndex(QQBTree):
+    """
+    Primary key -> base RID as packed unsigned 64-bit pairs, the same range as
+    page slots, kept in key order so a key range costs O(log n + matching keys)
+    however sparse the keys are.
+    """
+
+    def iter_range(self, lo, hi):
+        """Returns (key, rid) for every key between lo and hi inclusive, in key order."""
+        lo = max(lo, MIN_KEY)
+        hi = min(hi, MAX_KEY)
+        if lo > hi:
+            return iter(())
+        return self.items(min=lo, max=hi)
+
+
+INDEX_KINDS = {index_type.kind: index_type for index_type in (BTreeIndex, HashIndex)}
+
+
+def store_values(values, rids, new_values):
+    """Writes new_values into a covering array indexed by RID, growing it as needed."""
+    for rid, value in zip(rids, new_values):
+        if rid >= len(values):
+            values.extend([0] * (rid + 1 - len(values)))
+        values[rid] = value
+
+
 class Index:
 
     def __init__(self, table):
         # One index for each table. All our empty initially.
         self.indices = [None for _ in range(table.num_columns)]
+        # kind of index ("btree" or "hash") each column gets when it is (re)built
+        self.kinds = [DEFAULT_INDEX_KIND for _ in range(table.num_columns)]
         self.table = table
         self.key = table.key
-        self.column_lookup = {}
+        # adaptive mode indexes columns that selects keep filtering on and drops
+        # the indexes it built once they go unused
+        self.adaptive = False
+        self.selects = 0
+        self.select_counts = [0 for _ in range(table.num_columns)]
+        self.last_selected = [0 for _ in range(table.num_columns)]
+        self.adaptive_columns = set()
+        # selects on different threads note themselves one at a time
+        self.adaptive_lock = RLock()
+        # covering indexes: column -> {included column: array('Q') holding the
+        # latest value of that column by RID}, so covered queries skip the pages
+        self.covering = [None for _ in range(table.num_columns)]
+        # columns being built in the background, queries scan them meanwhile
+        self.building = set()
+        self.build_threads = []
 
     """
     # returns the location of all records with the given value on column "column"
     """
 
     def locate(self, column, value):
-        index = self.indices[column]
-        if not index.has_key(value):
+        tree = self.indices[column]
+        if tree is None:
+            # dropped since the caller checked is_indexed
+            return self.table.rid_lookup(column, value)
+        postings = tree.get(value)
+        if postings is None:
             return []
-        return index[value]
+        return postings.tolist()
 
     """
     # Returns the RIDs of all records with values in column "column" between "begin" and "end"
     """
 
     def locate_range(self, begin, end, column):
-        sublist = []
         index = self.indices[column]
-        for list1 in list(index.values(min=begin, max=end)):
-            sublist += list1
-        return sublist
+        return posting_lists.union(list(index.range(begin, end)), disjoint=True).tolist()
+
+    """
+    # Returns the RIDs of all records matching every (column, value) pair, all on indexed columns
+    """
+
+    def locate_all(self, conditions):
+        lists = []
+        for column, value in conditions:
+            postings = self.indices[column].get(value)
+            if postings is None:
+                return []
+            lists.append(postings)
+        return posting_lists.intersect(lists).tolist()
 
     """
     # optional: Create index on specific column
+    # Existing records are indexed by scanning the column pages, sorting the
+    # (value, RID) pairs and bulk loading the tree, in a background thread
+    # unless background is False. The column counts as not indexed until then.
+    # kind is "btree" (equality and ranges) or "hash" (equality only)
+    # include lists columns whose latest values are kept alongside, making the
+    # index covering. On the key column, which the RID map already indexes,
+    # only the included values are kept.
+    # An index already on the column is kept if it has the same kind and
+    # included columns, and rebuilt otherwise. Either way it is no longer one
+    # adaptive mode may drop.
     """
 
-    def create_index(self, column_number):
-        if self.indices[column_number] is None:
-            self.indices[column_number] = OOBTree()
+    def create_index(self, column_number, background=True, kind=DEFAULT_INDEX_KIND, include=()):
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"unknown index kind {kind}")
+        with self.adaptive_lock:
+            self.adaptive_columns.discard(column_number)
+        included = [column for column in include if column != column_number]
+        if column_number in self.building:
+            self.wait()
+        if column_number in self.maintained_columns():
+            if self.kinds[column_number] == kind and set(self.covering[column_number] or ()) == set(included):
+                return
+            self.drop_index(column_number)
+        self.kinds[column_number] = kind
+        if included:
+            self.covering[column_number] = {column: array('Q') for column in included}
+        if background:
+            self.build_in_background([column_number])
+        else:
+            self.building.add(column_number)
+            self.__build_locked([column_number])
+
+    def new_tree(self, column):
+        """Installs an empty index of the column's kind and returns it."""
+        tree = self.indices[column] = INDEX_KINDS[self.kinds[column]]()
+        return tree
 
     """
     # optional: Drop index of specific column
     """
 
     def drop_index(self, column_number):
-        self.indices[column_number] = None
+        # writers look the index up again after listing the indexed columns
+        with self.table.insert_lock, self.table.update_lock:
+            self.indices[column_number] = None
+            self.covering[column_number] = None
 
 
     def is_indexed(self, column):
-        return self.indices[column] == None
+        return column not in self.building and self.indices[column] is not None
+
+    def indexed_columns(self):
+        return [column for column, tree in enumerate(self.indices) if tree is not None]
+
+    def covering_columns(self):
+        return [column for column, store in enumerate(self.covering) if store is not None]
+
+    def maintained_columns(self):
+        """Columns with an index tree or a covering store to keep up to date."""
+        return sorted(set(self.indexed_columns()) | set(self.covering_columns()))
+
+    def is_maintained(self, column):
+        """Checks if an update to column has to be passed to update()."""
+        return self.is_indexed(column) or any(
+            column in self.covering[covering] for covering in self.covering_columns()
+            if covering not in self.building)
+
+    def covers(self, column, columns):
+        """Checks if the covering index on column holds the latest values of all the given columns."""
+        store = self.covering[column]
+        return (store is not None and column not in self.building
+                and all(included in store for included in columns))
+
+    def covered_values(self, column, rids, columns):
+        """
+        Returns one list of num_columns values per RID read from the covering
+        index on column, holding the given columns and None elsewhere, or None
+        if the index was dropped since covers() was checked.
+        """
+        store = self.covering[column]
+        if store is None:
+            return None
+        records = [[None] * self.table.num_columns for _ in rids]
+        for included in columns:
+            values = store[included]
+            for record, rid in zip(records, rids):
+                record[included] = values[rid]
+        return records
+
+    def set_adaptive(self, enabled):
+        """Turns adaptive indexing on or off. Indexes it already built are kept."""
+        self.adaptive = enabled
+
+    def note_select(self, column):
+        """
+        Records a select filtering on column. In adaptive mode a column selected
+        ADAPTIVE_INDEX_THRESHOLD times without ADAPTIVE_INDEX_IDLE other selects
+        in between gets an index, and indexes built this way are dropped after
+        ADAPTIVE_INDEX_IDLE selects that do not use them.
+        """
+        if not self.adaptive:
+            return
+        with self.adaptive_lock:
+            self.selects += 1
+            if self.selects - self.last_selected[column] > ADAPTIVE_INDEX_IDLE:
+                self.select_counts[column] = 0
+            self.select_counts[column] += 1
+            self.last_selected[column] = self.selects
+            if (self.indices[column] is None and column not in self.building
+                    and self.select_counts[column] >= ADAPTIVE_INDEX_THRESHOLD):
+                self.create_index(column)
+                self.adaptive_columns.add(column)
+            for idle in [column for column in self.adaptive_columns
+                         if self.selects - self.last_selected[column] > ADAPTIVE_INDEX_IDLE
+                         and column not in self.building]:
+                self.drop_index(idle)
+                self.adaptive_columns.discard(idle)
     
     def insert(self, columns, rid):
-        for index in range(1, self.table.num_columns):
-            if self.indices[index] == None:
-                self.create_index(index)
-            if not self.indices[index].has_key(columns[index]):
-                self.indices[index][columns[index]]= [rid]
+        for index in self.indexed_columns():
+            if columns[index] not in self.indices[index]:
+                self.indices[index][columns[index]]= posting_lists.new([rid])
+            else:
+                posting_lists.add(self.indices[index][columns[index]], rid)
+        for index in self.covering_columns():
+            for included, values in self.covering[index].items():
+                store_values(values, [rid], [columns[included]])
+
+    def remove(self, columns, rid):
+        """Removes a RID from the posting lists of its latest values (user columns only)."""
+        for index in self.indexed_columns():
+            self._discard(self.indices[index], columns[index], rid)
+
+    def update(self, rid, old_columns, new_columns):
+        """
+        Moves a RID to the posting lists of its new values. Both lists hold user
+        column values, with None for the columns the update left alone.
+        """
+        for index in self.indexed_columns():
+            tree = self.indices[index]
+            new_value = new_columns[index]
+            if tree is None or new_value is None or new_value == old_columns[index]:
+                continue
+            self._discard(tree, old_columns[index], rid)
+            postings = tree.get(new_value)
+            if postings is None:
+                tree[new_value] = posting_lists.new([rid])
+            else:
+                posting_lists.add(postings, rid)
+        for index in self.covering_columns():
+            for included, values in self.covering[index].items():
+                if new_columns[included] is not None:
+                    store_values(values, [rid], [new_columns[included]])
+
+    def _discard(self, tree, value, rid):
+        postings = tree.get(value)
+        if postings is not None and posting_lists.discard(postings, rid) and not postings:
+            del tree[value]
+
+    def insert_many(self, rows, rids):
+        """Indexes a batch of rows (user columns only) with their RIDs, one column at a time."""
+        for index in self.indexed_columns():
+            tree = self.indices[index]
+            for row, rid in zip(rows, rids):
+                value = row[index]
+                postings = tree.get(value)
+                if postings is None:
+                    tree[value] = posting_lists.new([rid])
+                else:
+                    posting_lists.add(postings, rid)
+        for index in self.covering_columns():
+            for included, values in self.covering[index].items():
+                store_values(values, rids, [row[included] for row in rows])
+
+    def bulk_insert(self, column, pairs):
+        """
+        Adds (value, rid) pairs to the index of column. The pairs are sorted
+        first so every value's posting list is built in one go and the tree is
+        filled in key order.
+        """
+        tree = self.indices[column]
+        if tree is None:
+            tree = self.new_tree(column)
+        new_postings = {}
+        for value, group in groupby(sorted(pairs), key=itemgetter(0)):
+            rids = posting_lists.new(rid for _, rid in group)
+            postings = tree.get(value)
+            if postings is None:
+                new_postings[value] = rids
             else:
-                self.indices[index][columns[index]].append(rid)
-            self.column_lookup[columns[index]] = index
+                tree[value] = posting_lists.union([postings, rids], disjoint=True)
+        tree.update(new_postings)
+
+    def build(self, first_rid=0, columns=None):
+        """
+        Indexes the latest values of the base records from first_rid on, a
+        column at a time, for the given columns (every maintained one by default),
+        and fills their covering stores.
+        """
+        for index in columns or self.maintained_columns():
+            if index != self.key:
+                self.bulk_insert(index, [(value, rid) for rid, value in self.table.scan_column(index, first_rid)])
+            for included, values in (self.covering[index] or {}).items():
+                pairs = list(self.table.scan_column(included, first_rid))
+                store_values(values, [rid for rid, _ in pairs], [value for _, value in pairs])
+
+    def build_in_background(self, columns=None):
+        """
+        Builds indexes from the table's pages in a background thread for the
+        given columns. Writers wait for the table locks until it is done;
+        readers scan those columns instead.
+        """
+        columns = list(columns)
+        self.building.update(columns)
+        thread = Thread(target=self.__build_locked, args=(columns,), daemon=True)
+        self.build_threads.append(thread)
+        thread.start()
+
+    def __build_locked(self, columns):
+        with self.table.insert_lock, self.table.update_lock:
+            for column in columns:
+                self.indices[column] = None
+                if self.covering[column] is not None:
+                    self.covering[column] = {included: array('Q') for included in self.covering[column]}
+            self.build(columns=columns)
+            self.building.difference_update(columns)
+
+    def wait(self):
+        """Waits for background builds to finish."""
+        while self.build_threads:
+            self.build_threads.pop().join()
+
+    def stamp(self):
+        """Identifies the table state the indexes were saved for."""
+        return (self.table.records, self.table.updates, len(self.table.page_directory))
+
+    def save(self, path):
+        """
+        Writes every index to path with its kind, in key order as three flat
+        arrays: the keys, the length of each posting list and all posting lists
+        back to back. Covering stores are written as their arrays.
+        """
+        self.wait()
+        columns = {}
+        for column, tree in enumerate(self.indices):
+            if tree is None:
+                continue
+            keys, counts, rids = array('Q'), array('Q'), array('Q')
+            for value, postings in tree.sorted_items():
+                keys.append(value)
+                counts.append(len(postings))
+                rids.extend(postings)
+            columns[column] = (tree.kind, keys, counts, rids)
+        covering = {column: self.covering[column] for column in self.covering_columns()}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            pickle.dump((self.stamp(), columns, covering), file)
 
+    def load(self, path):
+        """
+        Bulk loads indexes written by save. If they were saved for a different
+        table state the same columns are rebuilt in the background instead.
+        Returns False if there is no file.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as file:
+            stamp, columns, covering = pickle.load(file)
+        for column, store in covering.items():
+            self.covering[column] = store
+        if stamp != self.stamp():
+            for column, (kind, *_) in columns.items():
+                self.kinds[column] = kind
+            self.build_in_background(sorted(set(columns) | set(covering)))
+            return True
+        for column, (kind, keys, counts, rids) in columns.items():
+            self.kinds[column] = kind
+            tree = INDEX_KINDS[kind]()
+            items = []
+            start = 0
+            for value, count in zip(keys, counts):
+                items.append((value, rids[start:start + count]))
+                start += count
+            tree.update(items)
+            self.indices[column] = tree
+        return True
@@ -0,0 +1,53 @@
+from array import array
+from itertools import islice
+import csv
+
+"""
+Generator pipeline for bulk loading a table: a reader turns a file into rows
+of ints, batches() groups them, and Database.load inserts one batch at a time,
+so only a batch of rows is ever held in memory.
+"""
+
+BINARY_BLOCK_ROWS = 4096
+
+
+def read_csv(path, num_columns, skip_header=False):
+    """Yields one list of num_columns ints per non-empty CSV line."""
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        if skip_header:
+            next(reader, None)
+        for line_number, fields in enumerate(reader, 2 if skip_header else 1):
+            if not fields:
+                continue
+            if len(fields) != num_columns:
+                raise ValueError(f"{path}:{line_number}: expected {num_columns} columns, got {len(fields)}")
+            yield [int(field) for field in fields]
+
+
+def read_binary(path, num_columns):
+    """
+    Yields rows from a file of raw native-endian unsigned 64-bit integers,
+    num_columns per row, reading BINARY_BLOCK_ROWS rows at a time.
+    """
+    row_bytes = num_columns * array('Q').itemsize
+    with open(path, 'rb') as file:
+        while True:
+            block = file.read(row_bytes * BINARY_BLOCK_ROWS)
+            if not block:
+                return
+            if len(block) % row_bytes:
+                raise ValueError(f"{path}: trailing {len(block) % row_bytes} bytes do not form a row")
+            values = array('Q', block).tolist()
+            for start in range(0, len(values), num_columns):
+                yield values[start:start + num_columns]
+
+
+def batches(rows, size):
+    """Groups an iterable of rows into lists of at most size rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
@@ -1,40 +1,103 @@
 from lstore.config import *
+from operator import itemgetter
+from array import array
+from threading import Lock
+import sys
+
+# serializes taking private copies of mapped page data
+own_lock = Lock()
 
 class Page:
 
     def __init__(self):
         self.num_records = 0
-        self.data = bytearray(4096)
+        self.data = bytearray(PAGE_CAPACITY)
         self.is_dirty = False
         self.TPS = 0
         self.pinned = 0
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, buffer):
+        # values is a typed unsigned 64-bit view over the same bytes, so slot
+        # reads and writes never go through int.from_bytes / to_bytes
+        self._data = buffer
+        self.values = memoryview(buffer).cast('Q')
+
+    def own_data(self):
+        """
+        Replaces data that views a mapped segment with a private copy. Pages are
+        changed only through the copy, so a mapped slot changes only when the
+        page is written back along with its header and checksum.
+        """
+        if isinstance(self._data, memoryview):
+            with own_lock:
+                if isinstance(self._data, memoryview):
+                    self.data = bytearray(self._data)
 
     def has_capacity(self):
         return self.num_records < TUPLES_PER_PAGE
 
 
     def write(self, data):
-        self.data[self.num_records * 8:(self.num_records + 1) * 8] = int(data).to_bytes(8, byteorder='big')
+        self.own_data()
+        self.values[self.num_records] = int(data)
         self.num_records += 1
 
+    def write_many(self, data):
+        """Appends as many of the given values as fit and returns how many were written."""
+        count = min(len(data), TUPLES_PER_PAGE - self.num_records)
+        self.own_data()
+        self.values[self.num_records:self.num_records + count] = array('Q', data[:count])
+        self.num_records += count
+        return count
+
     def setAsdirty(self):
         self.is_dirty = True
 
     def get_value(self, ind):
-        value = int.from_bytes(self.data[ind * 8:(ind + 1) * 8], 'big')
-        return value
-    
+        return self.values[ind]
+
+    def get_values(self, slots=None):
+        """Returns the values of a slice of slots (all written slots by default)."""
+        if slots is None:
+            slots = slice(0, self.num_records)
+        return self.values[slots].tolist()
+
+    def get_slots(self, offsets):
+        """Returns the values stored at a list of slot offsets."""
+        if len(offsets) == 1:
+            return [self.values[offsets[0]]]
+        return list(itemgetter(*offsets)(self.values))
+
     def find_value(self, dest):
+        """Returns the offsets of all written slots holding dest."""
+        if not 0 <= dest <= MAX_64BIT_INT:
+            return []
+        pattern = int(dest).to_bytes(DATA_ENTRY_SIZE, sys.byteorder)
         offsets = []
-        for i in range(TUPLES_PER_PAGE):
-            value = int.from_bytes(self.data[i * 8:(i + 1) * 8], 'big')
-            if value == dest:
-                offsets.append(i)
-        return offsets        
+        end = self.num_records * DATA_ENTRY_SIZE
+        # memoryview buffers (mmap-backed pages) have no find
+        data = self._data if isinstance(self._data, bytearray) else self._data[:end].tobytes()
+        position = data.find(pattern, 0, end)
+        while position != -1:
+            if position % DATA_ENTRY_SIZE == 0:
+                offsets.append(position // DATA_ENTRY_SIZE)
+                position = data.find(pattern, position + DATA_ENTRY_SIZE, end)
+            else:
+                position = data.find(pattern, position + 1, end)
+        return offsets
+
+    def find_value_mask(self, predicate):
+        """Returns a list of booleans, one per written slot, from predicate(value)."""
+        return [bool(predicate(value)) for value in self.get_values()]
 
     def update(self, indx, data):
-        self.data[indx * 8:(indx + 1) * 8] = int(data).to_bytes(8, byteorder='big')
+        self.own_data()
+        self.values[indx] = int(data)
 
 class PageRange:
 
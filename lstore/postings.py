@@ -0,0 +1,64 @@
+from array import array
+from bisect import bisect_left, insort
+from itertools import chain, groupby
+
+"""
+Posting lists of secondary indexes are sorted array('Q') of RIDs: 8 bytes per
+RID instead of a list slot plus a boxed int. Membership is a binary search and
+the set operations below work on the sorted arrays directly.
+"""
+
+
+def new(rids=()):
+    """Returns a posting list holding rids, which must already be sorted."""
+    return array('Q', rids)
+
+
+def contains(postings, rid):
+    position = bisect_left(postings, rid)
+    return position < len(postings) and postings[position] == rid
+
+
+def add(postings, rid):
+    """Inserts a RID in order; new records have the highest RIDs and simply append."""
+    if not postings or rid > postings[-1]:
+        postings.append(rid)
+    else:
+        insort(postings, rid)
+
+
+def discard(postings, rid):
+    """Removes a RID if present and returns whether it was."""
+    position = bisect_left(postings, rid)
+    if position < len(postings) and postings[position] == rid:
+        del postings[position]
+        return True
+    return False
+
+
+def union(lists, disjoint=False):
+    """
+    Returns the sorted union of posting lists. Lists of different values of
+    one column never share a RID, pass disjoint=True to skip removing repeats.
+    """
+    lists = [postings for postings in lists if postings]
+    if len(lists) == 1:
+        return array('Q', lists[0])
+    # timsort merges the already sorted runs
+    merged = array('Q', sorted(chain.from_iterable(lists)))
+    if disjoint:
+        return merged
+    return array('Q', (rid for rid, _ in groupby(merged)))
+
+
+def intersect(lists):
+    """Returns the RIDs present in every posting list, probing the longer lists by binary search."""
+    lists = sorted(lists, key=len)
+    if not lists:
+        return array('Q')
+    result = array('Q', lists[0])
+    for postings in lists[1:]:
+        if not result:
+            break
+        result = array('Q', (rid for rid in result if contains(postings, rid)))
+    return result
@@ -1,8 +1,32 @@
 from lstore.table import Table, Record
 from lstore.index import Index
 from datetime import datetime
+from functools import lru_cache, wraps
 from lstore.config import *
 
+
+@lru_cache(maxsize=None)
+def merge_plan(schema):
+    """Returns the indexes of the columns set in a schema encoding bitmask."""
+    return tuple(column for column in range(schema.bit_length()) if schema >> column & 1)
+
+
+def stable_read(query):
+    """Runs a read query through Table.stable_read, retrying it if a compaction moved its records."""
+    @wraps(query)
+    def read(self, *args, **kwargs):
+        return self.table.stable_read(lambda: query(self, *args, **kwargs))
+    return read
+
+
+def fits_slot(values):
+    """
+    Checks that every value can be stored in an unsigned 64-bit page slot.
+    MAX_64BIT_INT is reserved, it marks the columns a tail record leaves unchanged.
+    """
+    return all(value is not None and 0 <= value < MAX_64BIT_INT for value in values)
+
+
 class Query:
     """
     # Creates a Query object that can perform different queries on the specified table 
@@ -22,10 +46,9 @@ class Query:
     # Return False if record doesn't exist or is locked due to 2PL
     """
     def delete(self, primary_key):
-        key = self.table.RID_map[primary_key]
-        del self.table.RID_map[primary_key]
-        del self.table.page_directory[key]
-        return True
+        if primary_key not in self.table.RID_map:
+            return False
+        return self.table.delete_record(primary_key)
     
     
     """
@@ -34,18 +57,41 @@ class Query:
     # Returns False if insert fails for whatever reason
     """
     def insert(self, *columns):
+        if len(columns) != self.table.num_columns or not fits_slot(columns):
+            return False
         colindx = columns[self.table.key]
-        if colindx in self.table.RID_map.keys():
+        if colindx in self.table.RID_map:
             return False;
         
-        self.table.insert_lock.acquire()
-        retrive_metadata = self.get_metadata(columns)
-        self.table.insert_base_record(retrive_metadata)
-        self.table.insert_lock.release()
+        with self.table.insert_lock:
+            retrive_metadata = self.get_metadata(columns)
+            self.table.insert_base_record(retrive_metadata)
+        return True
+
+    """
+    # Insert a batch of records, each a sequence of column values
+    # Return True upon succesful insertion
+    # Returns False, inserting nothing, if any key is already present or repeated,
+    # any row does not have one value per column or any value does not fit in a page slot
+    # index=False skips index maintenance, leaving it to a later Index.build
+    """
+    def insert_many(self, rows, index=True):
+        if not all(len(row) == self.table.num_columns and fits_slot(row) for row in rows):
+            return False
+        keys = [row[self.table.key] for row in rows]
+        if len(set(keys)) != len(keys) or any(key in self.table.RID_map for key in keys):
+            return False
+
+        with self.table.insert_lock:
+            first_rid = self.table.records
+            time = int(datetime.now().strftime("%Y%m%d%H%M%S"))
+            batch = [[rid, time, 0, MAX_64BIT_INT, rid, *row]
+                     for rid, row in enumerate(rows, first_rid)]
+            self.table.insert_base_records(batch, index)
         return True
 
     def get_metadata(self, columns):
-        schema_encoding = '0' * self.table.num_columns
+        schema_encoding = 0
         indirection = MAX_64BIT_INT
         rid = self.table.records
         time = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -64,66 +110,67 @@ class Query:
     # Returns False if record locked by TPL
     # Assume that select will never be called on a key that doesn't exist
     """
+    @stable_read
     def select(self, search_key, search_key_index, projected_columns_index):
         matched_rids = []
 
         # Determine how to retrieve the RID(s)
         if search_key_index == self.table.key:
-            if search_key in self.table.RID_map.keys():
+            if search_key in self.table.RID_map:
                 matched_rids.append(self.table.RID_map[search_key])
-        elif self.table.index.is_indexed(search_key_index):
-            matched_rids = self.table.index.locate(search_key_index, search_key)
         else:
-            matched_rids = self.table.rid_lookup(search_key_index, search_key)
+            self.table.index.note_select(search_key_index)
+            if self.table.index.is_indexed(search_key_index):
+                matched_rids = self.table.index.locate(search_key_index, search_key)
+            else:
+                matched_rids = self.table.rid_lookup(search_key_index, search_key)
 
         if len(matched_rids) == 0:
             return []  # Return empty list if no matching records
 
-        results = []
-        for rid in matched_rids:
-            retrieved_data = self.table.find_record(rid)
-            data_values = retrieved_data[DEFAULT_PAGE_COUNT : DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
-
-            # Check if record has been updated
-            if retrieved_data[INDIRECTION_COLUMN] != MAX_64BIT_INT:
-                tail_rid = retrieved_data[INDIRECTION_COLUMN]
-                tail_record = self.table.find_record(tail_rid)
-                updated_values = tail_record[DEFAULT_PAGE_COUNT : DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
-
-                schema_bits = retrieved_data[SCHEMA_ENCODING_COLUMN]
-                modified_columns = self.get_updated_columns(schema_bits)
-
-                # Apply updates from tail record
-                for idx, modified in enumerate(modified_columns):
-                    if modified:
-                        data_values[idx] = updated_values[idx]
+        projected = [idx for idx, should_include in enumerate(projected_columns_index) if should_include]
+        latest_values = self.latest_values(search_key_index, matched_rids, projected, [search_key] * len(matched_rids))
 
-            # Apply column projection filter
-            for idx, should_include in enumerate(projected_columns_index):
-                if not should_include:
-                    data_values[idx] = None
-
-            # Store retrieved record
+        results = []
+        for rid, data_values in zip(matched_rids, latest_values):
+            # Store retrieved record, unprojected columns are already None
             results.append(Record(rid, search_key, data_values))
 
         return results
 
-    def get_updated_columns(self, schema):
-        """Returns a list indicating which columns have been updated based on schema encoding."""
-        
-        num_columns = self.table.num_columns
-        updated_flags = [0] * num_columns
-
-        if schema == 0:
-            return updated_flags  # No updates detected
+    """
+    # Read every record whose primary key lies between start_range and end_range inclusive
+    # :param projected_columns_index: what columns to return. array of 1 or 0 values.
+    # Returns a list of Record objects in key order
+    """
+    @stable_read
+    def select_range(self, start_range, end_range, projected_columns_index):
+        matched = list(self.table.RID_map.iter_range(start_range, end_range))
+        projected = [idx for idx, should_include in enumerate(projected_columns_index) if should_include]
+        latest_values = self.latest_values(self.table.key, [rid for _, rid in matched], projected,
+                                           [key for key, _ in matched])
+        return [Record(rid, key, data_values) for (key, rid), data_values in zip(matched, latest_values)]
 
-        col_index = num_columns - 1
-        while schema:
-            updated_flags[col_index] = schema % 10  # Extract least significant digit
-            schema //= 10  # Shift encoding to the right
-            col_index -= 1  # Move to the next column
+    def latest_values(self, column, rids, projected, column_values):
+        """
+        Returns the latest projected values of rids found through column, read
+        from its covering index without touching any page when it holds all of
+        them. column_values gives the value each RID has in column.
+        """
+        included = [idx for idx in projected if idx != column]
+        records = None
+        if self.table.index.covers(column, included):
+            records = self.table.index.covered_values(column, rids, included)
+        if records is None:
+            return self.table.latest_records(rids, projected)
+        if column in projected:
+            for data_values, value in zip(records, column_values):
+                data_values[column] = value
+        return records
 
-        return updated_flags
+    def projected_columns(self, projected_columns_index):
+        """Returns the record column indexes of the user columns a projection selects."""
+        return [idx + DEFAULT_PAGE_COUNT for idx, should_include in enumerate(projected_columns_index) if should_include]
 
     """
     # Read matching record with specified search key
@@ -135,24 +182,28 @@ class Query:
     # Returns False if record locked by TPL
     # Assume that select will never be called on a key that doesn't exist
     """
+    @stable_read
     def select_version(self, search_key, search_key_index, projected_columns_index, relative_version):
         matched_rids = []
         # Determine how to retrieve the RID(s)
         if search_key_index == self.table.key:
-            if search_key in self.table.RID_map.keys():
+            if search_key in self.table.RID_map:
                 matched_rids.append(self.table.RID_map[search_key])
-        elif self.table.index.is_indexed(search_key_index):
-            matched_rids = self.table.index.locate(search_key_index, search_key)
         else:
-            matched_rids = self.table.rid_lookup(search_key_index, search_key)
+            self.table.index.note_select(search_key_index)
+            if self.table.index.is_indexed(search_key_index):
+                matched_rids = self.table.index.locate(search_key_index, search_key)
+            else:
+                matched_rids = self.table.rid_lookup(search_key_index, search_key)
 
         if len(matched_rids) == 0:
             return []  # Return empty list if no matching records
 
+        projected = self.projected_columns(projected_columns_index)
         results = []
         for rid in matched_rids:
-            retrieved_data = self.table.find_record(rid)
-            data_values = retrieved_data[DEFAULT_PAGE_COUNT : DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
+            retrieved_data = self.table.find_record(rid, [INDIRECTION_COLUMN] + projected)
+            base_values = retrieved_data[DEFAULT_PAGE_COUNT : DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
 
             # If the record has been updated, traverse the version history
             version_rid = rid  # Default: Base record
@@ -160,11 +211,18 @@ class Query:
 
             while retrieved_data[INDIRECTION_COLUMN] != MAX_64BIT_INT and version_count > relative_version:
                 version_rid = retrieved_data[INDIRECTION_COLUMN]  # Move to the latest update
-                retrieved_data = self.table.find_record(version_rid)  # Fetch the updated record
+                retrieved_data = self.table.find_record(version_rid, [INDIRECTION_COLUMN])  # Follow the version chain
+
                 version_count -= 1  # Move back one step
 
-            # Fetch the correct version's values
-            data_values = retrieved_data[DEFAULT_PAGE_COUNT : DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
+            # Fetch the correct version's values, a tail record only holds the columns in its schema
+            data_values = list(base_values)
+            if version_rid != rid:
+                schema = self.table.find_record(version_rid, [SCHEMA_ENCODING_COLUMN])[SCHEMA_ENCODING_COLUMN]
+                updated = [idx for idx in merge_plan(schema) if projected_columns_index[idx]]
+                tail_record = self.table.find_record(version_rid, [idx + DEFAULT_PAGE_COUNT for idx in updated])
+                for idx in updated:
+                    data_values[idx] = tail_record[idx + DEFAULT_PAGE_COUNT]
 
             # Apply column projection
             for idx, should_include in enumerate(projected_columns_index):
@@ -185,52 +243,68 @@ class Query:
     def update(self, primary_key, *columns):
         columns = list(columns)
         
-        if primary_key not in self.table.RID_map.keys():
+        if primary_key not in self.table.RID_map:
             return False
-        if columns[self.table.key] in self.table.RID_map.keys():
+        if columns[self.table.key] in self.table.RID_map:
             return False
         if columns[self.table.key] != None:
             return False
+        if not fits_slot(content for content in columns if content != None):
+            return False
         
-        self.table.update_lock.acquire()
+        with self.table.update_lock:
+            # the key may have been deleted since it was checked
+            if primary_key not in self.table.RID_map:
+                return False
 
-        rid = self.table.RID_map[primary_key]
-        base_id = rid
-        address = self.table.page_directory[rid]
-        updated_schema = '' 
-        latest_rid = self.table.records
-        data = self.table.find_record(rid)
-        indirection = data[INDIRECTION_COLUMN]
-        entry_time = datetime.now().strftime("%Y%m%d%H%M%S")
-        if indirection == MAX_64BIT_INT:
-            update_chain_rid = rid
+            rid = self.table.RID_map[primary_key]
+            base_id = rid
+            address = self.table.page_directory[rid]
+            updated_schema = 0
             for idx, content in enumerate(columns):
-                if content == None:
-                    updated_schema += '0'
-                    columns[idx] = MAX_64BIT_INT
-                else:
-                    updated_schema += '1'
-        else:
-            last_tail_record = self.table.find_record(indirection)
-            update_chain_rid = last_tail_record[RID_COLUMN]
-            schema = last_tail_record[SCHEMA_ENCODING_COLUMN]
-            schema = self.get_updated_columns(schema)
-            for idx, content in enumerate(schema):
-                if columns[idx] != None:
-                    updated_schema += '1'
-                else:
+                if content != None:
+                    updated_schema |= 1 << idx
+            latest_rid = self.table.records
+            # values the update replaces in indexed columns, to move the RID in those
+            # indexes, and new values of the columns covering indexes include
+            reindexed = [idx for idx, content in enumerate(columns)
+                         if content != None and self.table.index.is_maintained(idx)]
+            new_values = [columns[idx] if idx in reindexed else None for idx in range(self.table.num_columns)]
+            if reindexed:
+                indexed = [idx for idx in reindexed if self.table.index.is_indexed(idx)]
+                old_values = self.table.latest_records([rid], indexed)[0] if indexed else [None] * self.table.num_columns
+            data = self.table.find_record(rid, [INDIRECTION_COLUMN, SCHEMA_ENCODING_COLUMN])
+            indirection = data[INDIRECTION_COLUMN]
+            entry_time = datetime.now().strftime("%Y%m%d%H%M%S")
+            if indirection == MAX_64BIT_INT:
+                update_chain_rid = rid
+                for idx, content in enumerate(columns):
+                    if content == None:
+                        columns[idx] = MAX_64BIT_INT
+            else:
+                # the base schema encoding matches the latest tail record, so only
+                # the columns earlier updates changed are read to carry them forward
+                last_schema = data[SCHEMA_ENCODING_COLUMN]
+                carried = [idx for idx in merge_plan(last_schema) if columns[idx] == None]
+                last_tail_record = self.table.find_record(indirection, [idx + DEFAULT_PAGE_COUNT for idx in carried])
+                update_chain_rid = indirection
+                for idx, content in enumerate(columns):
+                    if content == None:
+                        columns[idx] = MAX_64BIT_INT
+                for idx in carried:
                     columns[idx] = last_tail_record[idx + DEFAULT_PAGE_COUNT]
-                    updated_schema += '1' if last_tail_record[idx + DEFAULT_PAGE_COUNT] != MAX_64BIT_INT else '0'
-        
-        # update base record
-        self.table.update_value(INDIRECTION_COLUMN, address, latest_rid)
-        self.table.update_value(SCHEMA_ENCODING_COLUMN, address, updated_schema)
-        
-        retrive_metadata = [latest_rid, int(entry_time), updated_schema, update_chain_rid, base_id]
-        retrive_metadata.extend(columns)
-        self.table.tail_write(retrive_metadata)
-        
-        self.table.update_lock.release()
+                updated_schema |= last_schema
+
+            retrive_metadata = [latest_rid, int(entry_time), updated_schema, update_chain_rid, base_id]
+            retrive_metadata.extend(columns)
+            self.table.tail_write(retrive_metadata)
+
+            # update base record only once the tail record is addressable, so
+            # concurrent readers never follow an indirection that isn't written yet
+            self.table.update_value(INDIRECTION_COLUMN, address, latest_rid)
+            self.table.update_value(SCHEMA_ENCODING_COLUMN, address, updated_schema)
+            if reindexed:
+                self.table.index.update(rid, old_values, new_values)
         return True
 
     
@@ -242,25 +316,13 @@ class Query:
     # Returns the summation of the given range upon success
     # Returns False if no record exists in the given range
     """
+    @stable_read
     def sum(self, start_range, end_range, aggregate_column_index):
         sum_result = 0
-        data_col_index = aggregate_column_index + DEFAULT_PAGE_COUNT
-        for index in range(start_range, end_range + 1):
-            if index in self.table.RID_map.keys():
-                record_id = self.table.RID_map[index]
-                stored_data = self.table.find_record(record_id)
-                if stored_data[INDIRECTION_COLUMN] == MAX_64BIT_INT:
-                    sum_result += stored_data[data_col_index]
-                else:
-                    modified_rid = stored_data[INDIRECTION_COLUMN]
-                    tail_version = self.table.find_record(modified_rid)
-                    new_column_value = tail_version[DEFAULT_PAGE_COUNT:DEFAULT_PAGE_COUNT + self.table.num_columns + 1]
-                    schema = tail_version[SCHEMA_ENCODING_COLUMN]
-                    schema = self.get_updated_columns(schema)
-                    if schema[aggregate_column_index] == 1:
-                        sum_result += new_column_value[aggregate_column_index]
-                    else:
-                        sum_result += stored_data[data_col_index]
+        matched = list(self.table.RID_map.iter_range(start_range, end_range))
+        for data_values in self.latest_values(self.table.key, [rid for _, rid in matched], [aggregate_column_index],
+                                              [key for key, _ in matched]):
+            sum_result += data_values[aggregate_column_index]
 
         return sum_result
 
@@ -1,15 +1,12 @@
-from lstore.index import Index
+from lstore.index import Index, PrimaryKeyIndex
 from time import time
 from collections import defaultdict
-from threading import Lock
+from threading import Lock, Thread, Event
 from lstore.bufferpool import BufferPool
+from lstore.page import Page
+from lstore.directory import PageDirectory
 from lstore.config import *
 
-INDIRECTION_COLUMN = 0
-RID_COLUMN = 1
-TIMESTAMP_COLUMN = 2
-SCHEMA_ENCODING_COLUMN = 3
-
 
 class Record:
 
@@ -29,7 +26,7 @@ class Table:
         self.name = name
         self.key = key
         self.num_columns = num_columns
-        self.page_directory = {}
+        self.page_directory = PageDirectory(name)
         self.index = Index(self)
 
         self.total_columns = self.num_columns + DEFAULT_PAGE_COUNT
@@ -37,44 +34,101 @@ class Table:
 
         self.records = 0
         self.updates = 0
-        self.RID_map = {}
+        # page range -> tail records written to that range's own tail pages
+        self.tail_counts = []
+        self.RID_map = PrimaryKeyIndex()
         
         self.lock_manager = defaultdict()
         self.insert_lock = Lock()
         self.update_lock = Lock()
 
+        # (page range, base page) -> TPS of its merged copy. Replaced, never
+        # mutated, so readers can take a consistent snapshot without a lock.
+        self.merged = {}
+        self.pending_merge = set()
+        self.merge_requested = Event()
+        self.merge_stop = False
+        self.merge_thread = None
+        self.maintenance_lock = Lock()
+
+        # page range -> base records deleted from it. Full ranges whose live
+        # fraction drops below COMPACTION_THRESHOLD are rewritten and freed.
+        self.deleted_counts = []
+        self.freed_ranges = set()
+        self.pending_compaction = set()
+        # bumped when a range starts and when it finishes being compacted, so
+        # it is odd while one is rewritten; see stable_read
+        self.compactions = 0
+        # bumped as a delete starts and as it ends, so it is odd while RIDs are
+        # being removed; a read that misses a RID then retries, see stable_read
+        self.deletes = 0
+
     def get_rid(self, key):
         return self.RID_map[key]
         
         
     def set_path(self, path):
         self.path = path
-        BufferPool.set_storage_path(self.path)
 
-    def find_page_address(self, page_type):
-        tail_count = self.updates
-        base_count = self.records - tail_count
-        pindx = base_count % TUPLES_PER_PAGERANGE
+    def find_page_address(self, page_type, pindx=None):
+        """
+        Returns (page range, page) the next record of page_type goes to. Tail
+        records go to the tail pages of their base record's range, given as pindx.
+        """
         if page_type == 'base':
-            bindx = base_count % TUPLES_PER_PAGE
+            base_count = self.records - self.updates
+            pindx = base_count // TUPLES_PER_PAGERANGE
+            bindx = (base_count % TUPLES_PER_PAGERANGE) // TUPLES_PER_PAGE
             return pindx, bindx
         else:
-            tindx = tail_count % TUPLES_PER_PAGE
+            if pindx >= len(self.tail_counts):
+                self.tail_counts.extend([0] * (pindx + 1 - len(self.tail_counts)))
+            tindx = self.tail_counts[pindx] // TUPLES_PER_PAGE
             return pindx, tindx
 
     def insert_base_record(self, columns):
         pindx, bindx = self.find_page_address('base')
         for i, value in enumerate(columns):     
             id = (self.name, "base", i, pindx, bindx)
-            page = BufferPool.get(id)
-            pindx, bindx, id = self._handle_page_capacity(page, pindx, bindx, i)
+            page = BufferPool.pin(id)
+            pindx, bindx, id = self._handle_page_capacity(page, pindx, bindx, i, "base")
             page.write(value)
             offset = page.num_records - 1
             BufferPool.update_cache(id, page)
+            BufferPool.unpin(page)
+
+        self._update_metadata(columns, pindx, bindx, offset, "base")
+
+    def insert_base_records(self, batch, index=True):
+        """
+        Inserts a batch of full records (metadata first, RIDs consecutive from
+        self.records). Each base page gets whole column slices appended at once
+        and the directory, RID map and indexes are updated once per page.
+        With index=False the indexes are left for the caller to build.
+        """
+        position = 0
+        while position < len(batch):
+            pindx, bindx = self.find_page_address('base')
+            room = TUPLES_PER_PAGE - (self.records - self.updates) % TUPLES_PER_PAGE
+            chunk = batch[position:position + room]
+            for i, values in enumerate(zip(*chunk)):
+                id = (self.name, "base", i, pindx, bindx)
+                page = BufferPool.pin(id)
+                offset = page.num_records
+                page.write_many(values)
+                BufferPool.update_cache(id, page)
+                BufferPool.unpin(page)
 
-        self._update_metadata(columns, pindx, bindx, offset)
+            rids = [record[RID_COLUMN] for record in chunk]
+            rows = [record[DEFAULT_PAGE_COUNT:] for record in chunk]
+            self.page_directory.set_run(rids[0], "base", pindx, bindx, offset, len(chunk))
+            self.RID_map.update(dict(zip([row[self.key] for row in rows], rids)))
+            if index:
+                self.index.insert_many(rows, rids)
+            self.records += len(chunk)
+            position += len(chunk)
 
-    def _handle_page_capacity(self, page, pindx, bindx, col_index):
+    def _handle_page_capacity(self, page, pindx, bindx, col_index, page_type):
         """Handles page capacity and updates page indices if needed."""
         if not page.has_capacity():
             if bindx == MAX_PAGES_PER_RANGE - 1:
@@ -82,51 +136,425 @@ class Table:
                 bindx = 0
             else:
                 bindx += 1
-        return pindx, bindx, (self.name, "base", col_index, pindx, bindx)
+        return pindx, bindx, (self.name, page_type, col_index, pindx, bindx)
 
-    def _update_metadata(self, columns, pindx, bindx, offset):
+    def _update_metadata(self, columns, pindx, bindx, offset, page_type):
         """Updates metadata like page directory, RID map, and record count."""
         rid = columns[0]
-        self.page_directory[rid] = [self.name, "base", pindx, bindx, offset]
-        self.RID_map[columns[self.key + DEFAULT_PAGE_COUNT]] = rid
+        self.page_directory[rid] = [self.name, page_type, pindx, bindx, offset]
         self.records += 1
-        self.index.insert(columns[DEFAULT_PAGE_COUNT:], rid)
+        if page_type == "base":
+            self.RID_map[columns[self.key + DEFAULT_PAGE_COUNT]] = rid
+            self.index.insert(columns[DEFAULT_PAGE_COUNT:], rid)
 
     def tail_write(self, columns):
-        pindx, tindx = self.find_page_address('tail')
+        base_location = self.page_directory[columns[BASE_ID]]
+        pindx, tindx = self.find_page_address('tail', base_location[2])
         for i, value in enumerate(columns):
             id = (self.name, "tail", i, pindx, tindx)
-            page = BufferPool.get(id)
-            pindx, tindx, id = self._handle_page_capacity(page, pindx, tindx, i)        
-            page = BufferPool.get(id)
+            page = BufferPool.pin(id)
             page.write(value)
             offset = page.num_records - 1
             BufferPool.update_cache(id, page)
-        self._update_metadata(columns, pindx, tindx, offset)
+            BufferPool.unpin(page)
+        self._update_metadata(columns, pindx, tindx, offset, "tail")
+        self.tail_counts[pindx] += 1
         self.updates += 1
 
+        self.pending_merge.add((base_location[2], base_location[3]))
+        if self.updates % MERGE_THRESHOLD == 0:
+            self.request_merge()
+
+    def delete_record(self, key):
+        """
+        Deletes the record with the given primary key. The base record and every
+        tail record of its chain get MAX_64BIT_INT as a tombstone in their RID
+        column and leave the page directory, RID map and indexes.
+        Returns False if the key is not present.
+        """
+        with self.update_lock:
+            if key not in self.RID_map:
+                return False
+            rid = self.RID_map[key]
+            self.deletes += 1
+            try:
+                self.__remove_record(key, rid)
+            finally:
+                self.deletes += 1
+        return True
+
+    def __remove_record(self, key, rid):
+        location = self.page_directory[rid]
+        latest = self.latest_records([rid], list(range(self.num_columns)))[0]
+        tail_rid = self.find_value(INDIRECTION_COLUMN, location)
+        # the oldest tail record points back at the base record
+        while tail_rid != MAX_64BIT_INT and tail_rid != rid:
+            tail_location = self.page_directory[tail_rid]
+            next_rid = self.find_value(INDIRECTION_COLUMN, tail_location)
+            self.update_value(RID_COLUMN, tail_location, MAX_64BIT_INT)
+            del self.page_directory[tail_rid]
+            tail_rid = next_rid
+        self.update_value(RID_COLUMN, location, MAX_64BIT_INT)
+        self.index.remove(latest, rid)
+        del self.RID_map[key]
+        del self.page_directory[rid]
+        self.__count_deleted(location[2])
+
+    def __count_deleted(self, pindx):
+        self.__track_range(pindx)
+        self.deleted_counts[pindx] += 1
+        full = (pindx + 1) * TUPLES_PER_PAGERANGE <= self.records - self.updates
+        live_fraction = 1 - self.deleted_counts[pindx] / TUPLES_PER_PAGERANGE
+        if full and live_fraction < COMPACTION_THRESHOLD and pindx not in self.pending_compaction:
+            self.pending_compaction.add(pindx)
+            self.request_merge()
+
+    def __track_range(self, pindx):
+        """Extends deleted_counts to hold an entry for page range pindx."""
+        if pindx >= len(self.deleted_counts):
+            self.deleted_counts.extend([0] * (pindx + 1 - len(self.deleted_counts)))
+
+    def compact(self, pindx=None):
+        """
+        Rewrites the page ranges queued for compaction, or just range pindx.
+        Live records are reinserted at their latest values under new RIDs, then
+        the range's pages and segment files are dropped; earlier versions of
+        the moved records are not kept. Writers wait while a range is rewritten.
+        """
+        if pindx is None:
+            with self.update_lock:
+                pending, self.pending_compaction = self.pending_compaction, set()
+        else:
+            pending = {pindx}
+        for pindx in sorted(pending):
+            self.__compact_range(pindx)
+
+    def __compact_range(self, pindx):
+        with self.maintenance_lock, self.insert_lock, self.update_lock:
+            if pindx in self.freed_ranges or (pindx + 1) * TUPLES_PER_PAGERANGE > self.records - self.updates:
+                return
+            self.compactions += 1
+            try:
+                self.__rewrite_range(pindx)
+            finally:
+                self.compactions += 1
+
+    def __rewrite_range(self, pindx):
+        """
+        Moves the live records of a range to new RIDs, then frees the range.
+        The RID map and indexes point at the new RIDs before the old ones leave
+        the page directory, so a key always resolves to a record that exists.
+        """
+        # ranges without deletes have no entry yet, add it before anything moves
+        self.__track_range(pindx)
+        rids = []
+        for bindx in range(MAX_PAGES_PER_RANGE):
+            page = BufferPool.pin((self.name, "base", RID_COLUMN, pindx, bindx))
+            rids.extend(rid for rid in page.get_values() if rid in self.page_directory)
+            BufferPool.unpin(page)
+        tail_rids = []
+        tail_count = self.tail_counts[pindx] if pindx < len(self.tail_counts) else 0
+        for tindx in range(-(-tail_count // TUPLES_PER_PAGE)):
+            page = BufferPool.pin((self.name, "tail", RID_COLUMN, pindx, tindx))
+            tail_rids.extend(rid for rid in page.get_values() if rid in self.page_directory)
+            BufferPool.unpin(page)
+
+        originals = self.fetch_records(rids, [TIMESTAMP_COLUMN])
+        latest = self.latest_records(rids, list(range(self.num_columns)))
+        # insert_base_records points the RID map and indexes at the new RIDs
+        batch = [[rid, original[TIMESTAMP_COLUMN], 0, MAX_64BIT_INT, rid, *values]
+                 for rid, original, values in zip(range(self.records, self.records + len(rids)), originals, latest)]
+        self.insert_base_records(batch)
+
+        for rid, values in zip(rids, latest):
+            self.index.remove(values, rid)
+            del self.page_directory[rid]
+        for rid in tail_rids:
+            del self.page_directory[rid]
+
+        self.merged = {page: tps for page, tps in self.merged.items() if page[0] != pindx}
+        self.pending_merge = {page for page in self.pending_merge if page[0] != pindx}
+        if pindx < len(self.tail_counts):
+            self.tail_counts[pindx] = 0
+        self.deleted_counts[pindx] = TUPLES_PER_PAGERANGE
+        self.freed_ranges.add(pindx)
+        BufferPool.drop_range(self.name, pindx)
+
+    def stable_read(self, read):
+        """
+        Returns read() once it ran without overlapping a compaction. Readers
+        take no locks, and a compaction can drop the RIDs and pages a read
+        resolved before, which then raises KeyError or reads an empty page.
+        A read that misses a RID a concurrent delete removed is retried too,
+        the deleted record is then no longer found.
+        """
+        while True:
+            compactions, deletes = self.compactions, self.deletes
+            if compactions % 2:
+                # a range is being rewritten, wait for it to finish
+                with self.maintenance_lock:
+                    pass
+                continue
+            try:
+                result = read()
+            except KeyError:
+                if self.compactions == compactions and self.deletes == deletes and deletes % 2 == 0:
+                    raise
+                continue
+            if self.compactions == compactions:
+                return result
+
+    def scan_column(self, col_index, first_rid=0):
+        """
+        Yields (rid, latest value) of user column col_index for every live base
+        record with RID >= first_rid, reading one base page at a time.
+        """
+        base_count = self.records - self.updates
+        first_page = 0
+        if first_rid in self.page_directory:
+            location = self.page_directory[first_rid]
+            first_page = location[2] * MAX_PAGES_PER_RANGE + location[3]
+        for page_number in range(first_page, -(-base_count // TUPLES_PER_PAGE)):
+            pindx, bindx = divmod(page_number, MAX_PAGES_PER_RANGE)
+            if pindx in self.freed_ranges:
+                continue
+            rid_page = BufferPool.pin((self.name, "base", RID_COLUMN, pindx, bindx))
+            rids = [rid for rid in rid_page.get_values() if rid >= first_rid and rid in self.page_directory]
+            BufferPool.unpin(rid_page)
+            for rid, values in zip(rids, self.latest_records(rids, [col_index])):
+                yield rid, values[col_index]
+
     def rid_lookup(self, col_index, search_val):
-        return [
-            rid for rid in self.page_directory 
-            if self.find_record(rid)[col_index + DEFAULT_PAGE_COUNT] == search_val
-        ]
+        """Returns the base RIDs whose latest value in user column col_index equals search_val."""
+        return self.scan(col_index, lambda value: value == search_val,
+                         lambda page: page.find_value(search_val))
+
+    def scan(self, col_index, predicate, match_page=None):
+        """
+        Returns, in RID order, the live base RIDs whose latest value in user
+        column col_index satisfies predicate. The column is tested a whole base
+        (or merged) page at a time, through match_page(page) returning the
+        matching slot offsets when given. Tail records are only read for rows
+        whose column was updated after their page was merged.
+        """
+        if match_page is None:
+            match_page = lambda page: [offset for offset, hit in enumerate(page.find_value_mask(predicate)) if hit]
+        merged = self.merged
+        column = col_index + DEFAULT_PAGE_COUNT
+        matches = []
+        base_count = self.records - self.updates
+        for page_number in range(-(-base_count // TUPLES_PER_PAGE)):
+            pindx, bindx = divmod(page_number, MAX_PAGES_PER_RANGE)
+            if pindx in self.freed_ranges:
+                continue
+            tps = merged.get((pindx, bindx), -1)
+            source = "merged" if tps >= 0 else "base"
+            pages = [BufferPool.pin((self.name, "base", metadata, pindx, bindx))
+                     for metadata in (RID_COLUMN, INDIRECTION_COLUMN, SCHEMA_ENCODING_COLUMN)]
+            pages.append(BufferPool.pin((self.name, source, column, pindx, bindx)))
+            rids, chain, schema = [page.get_values() for page in pages[:3]]
+            # a concurrent insert may have reached the RID page and not yet the
+            # others, its record is newer than this scan
+            rids = rids[:min(len(chain), len(schema))]
+            hits = set(match_page(pages[3]))
+            for page in pages:
+                BufferPool.unpin(page)
+
+            page_matches = []
+            tail_rids = []
+            tail_bases = []
+            for offset, rid in enumerate(rids):
+                if rid not in self.page_directory:
+                    continue
+                indirection = chain[offset]
+                if indirection != MAX_64BIT_INT and indirection > tps and schema[offset] >> col_index & 1:
+                    tail_rids.append(indirection)
+                    tail_bases.append(rid)
+                elif offset in hits:
+                    page_matches.append(rid)
+            for rid, tail_record in zip(tail_bases, self.fetch_records(tail_rids, [column])):
+                if predicate(tail_record[column]):
+                    page_matches.append(rid)
+            page_matches.sort()
+            matches.extend(page_matches)
+        return matches
 
     def find_value(self, col_index, address):
-        page = BufferPool.get((address[0], address[1], col_index, address[2], address[3]))
-        return page.get_value(address[4])
+        page = BufferPool.pin((address[0], address[1], col_index, address[2], address[3]))
+        value = page.get_value(address[4])
+        BufferPool.unpin(page)
+        return value
 
     def update_value(self, col_index, address, val):
         id = (address[0], address[1], col_index, address[2], address[3])
-        page = BufferPool.get(id)
+        page = BufferPool.pin(id)
         page.update(address[4], val)
         BufferPool.update_cache(id, page)
+        BufferPool.unpin(page)
 
-    def find_record(self, rid):
+    def find_record(self, rid, columns=None):
+        """
+        Returns every column of a record, metadata first. If columns is given
+        only those column indexes are read and the other entries are None.
+        """
         location = self.page_directory[rid]
-        return [self.find_value(i, location) for i in range(DEFAULT_PAGE_COUNT + self.num_columns)]
+        if columns is None:
+            return [self.find_value(i, location) for i in range(DEFAULT_PAGE_COUNT + self.num_columns)]
+        record = [None] * (DEFAULT_PAGE_COUNT + self.num_columns)
+        for i in columns:
+            record[i] = self.find_value(i, location)
+        return record
+
+    def fetch_records(self, rids, columns, merged=None):
+        """
+        Returns find_record(rid, columns) for every rid in order. RIDs are grouped
+        by the page they live on so each page is looked up once per column.
+        If a merged snapshot is given, user columns of base records are read
+        from the merged copy of their page when there is one.
+        """
+        if len(rids) == 1 and not merged:
+            return [self.find_record(rids[0], columns)]
+        records = [[None] * (DEFAULT_PAGE_COUNT + self.num_columns) for _ in rids]
+        pages = defaultdict(list)
+        for position, rid in enumerate(rids):
+            location = self.page_directory[rid]
+            pages[(location[1], location[2], location[3])].append((position, location[4]))
+        for (page_type, pindx, bindx), slots in pages.items():
+            data_type = page_type
+            if merged and page_type == "base" and (pindx, bindx) in merged:
+                data_type = "merged"
+            offsets = [offset for _, offset in slots]
+            for column in columns:
+                source = data_type if column >= DEFAULT_PAGE_COUNT else page_type
+                page = BufferPool.pin((self.name, source, column, pindx, bindx))
+                values = page.get_slots(offsets)
+                BufferPool.unpin(page)
+                for (position, _), value in zip(slots, values):
+                    records[position][column] = value
+        return records
+
+    def latest_records(self, rids, columns):
+        """
+        Returns the latest values of the given user columns for a list of base
+        RIDs, one list of num_columns values per RID with None for the columns
+        not asked for. Merged base pages are used where they exist, so a tail
+        record is only read for updates newer than the page's TPS.
+        """
+        # take the snapshot before reading pages: a merge installs its pages
+        # first and only then publishes their TPS, so an older TPS is safe
+        merged = self.merged
+        physical = [column + DEFAULT_PAGE_COUNT for column in columns]
+        records = self.fetch_records(rids, [INDIRECTION_COLUMN, SCHEMA_ENCODING_COLUMN] + physical, merged)
+
+        tail_rids = []
+        tail_positions = []
+        tail_columns = set()
+        for position, (rid, record) in enumerate(zip(rids, records)):
+            indirection = record[INDIRECTION_COLUMN]
+            if indirection == MAX_64BIT_INT:
+                continue
+            location = self.page_directory[rid]
+            if indirection <= merged.get((location[2], location[3]), -1):
+                continue
+            updated = [column for column in physical if record[SCHEMA_ENCODING_COLUMN] >> (column - DEFAULT_PAGE_COUNT) & 1]
+            if updated:
+                tail_rids.append(indirection)
+                tail_positions.append(position)
+                tail_columns.update(updated)
+
+        for position, tail_record in zip(tail_positions, self.fetch_records(tail_rids, sorted(tail_columns))):
+            record = records[position]
+            for column in physical:
+                if record[SCHEMA_ENCODING_COLUMN] >> (column - DEFAULT_PAGE_COUNT) & 1:
+                    record[column] = tail_record[column]
+
+        return [record[DEFAULT_PAGE_COUNT:] for record in records]
+
+    def request_merge(self):
+        """Wakes the background merge and compaction thread, starting it on first use."""
+        if self.merge_thread is None:
+            self.merge_thread = Thread(target=self.__run_merge, daemon=True)
+            self.merge_thread.start()
+        self.merge_requested.set()
+
+    def stop_merge(self):
+        """Stops the background merge thread after any merge in progress."""
+        if self.merge_thread is None:
+            return
+        self.merge_stop = True
+        self.merge_requested.set()
+        self.merge_thread.join()
+        self.merge_thread = None
+        self.merge_stop = False
+
+    def __run_merge(self):
+        while True:
+            self.merge_requested.wait()
+            self.merge_requested.clear()
+            if self.merge_stop:
+                return
+            self.__merge()
+            if self.pending_compaction:
+                self.compact()
 
-    
     def __merge(self):
-        print("merge is happening")
-        pass
+        """
+        Consolidates tail records into merged copies of the full base pages that
+        were updated since the last merge. Only user columns are copied: the
+        metadata columns keep being updated in place on the base pages, and the
+        original base pages stay untouched for select_version.
+        """
+        with self.maintenance_lock:
+            with self.update_lock:
+                # every tail record below the watermark is completely written
+                watermark = self.records
+                base_count = self.records - self.updates
+                pending = self.pending_merge
+                self.pending_merge = set()
+
+            for pindx, bindx in sorted(pending):
+                if (pindx * MAX_PAGES_PER_RANGE + bindx + 1) * TUPLES_PER_PAGE > base_count:
+                    # the page is still being appended to, merge it once it is full
+                    self.pending_merge.add((pindx, bindx))
+                    continue
+                self.__merge_page(pindx, bindx, watermark)
+
+    def __merge_page(self, pindx, bindx, watermark):
+        previous_tps = self.merged.get((pindx, bindx), -1)
+        source = "merged" if previous_tps >= 0 else "base"
+        indirection = BufferPool.pin((self.name, "base", INDIRECTION_COLUMN, pindx, bindx))
+        schema = BufferPool.pin((self.name, "base", SCHEMA_ENCODING_COLUMN, pindx, bindx))
+        chain = list(zip(indirection.get_values(), schema.get_values()))
+        BufferPool.unpin(indirection)
+        BufferPool.unpin(schema)
+
+        copies = []
+        for column in range(DEFAULT_PAGE_COUNT, DEFAULT_PAGE_COUNT + self.num_columns):
+            page = BufferPool.pin((self.name, source, column, pindx, bindx))
+            copy = Page()
+            copy.data[:] = page.data
+            copy.num_records = page.num_records
+            BufferPool.unpin(page)
+            copies.append(copy)
+
+        for offset, (tail_rid, mask) in enumerate(chain):
+            # the latest tail record carries every column updated so far
+            if tail_rid == MAX_64BIT_INT or tail_rid <= previous_tps or tail_rid >= watermark:
+                continue
+            columns = [column + DEFAULT_PAGE_COUNT for column in range(self.num_columns) if mask >> column & 1]
+            try:
+                tail_record = self.find_record(tail_rid, columns)
+            except KeyError:
+                # the record was deleted after its indirection was read
+                continue
+            for column in columns:
+                copies[column - DEFAULT_PAGE_COUNT].update(offset, tail_record[column])
+
+        tps = watermark - 1
+        for column, copy in enumerate(copies, DEFAULT_PAGE_COUNT):
+            copy.TPS = tps
+            BufferPool.update_cache((self.name, "merged", column, pindx, bindx), copy)
+        merged = dict(self.merged)
+        merged[(pindx, bindx)] = tps
+        self.merged = merged
  